@@ -6,14 +6,16 @@ https://github.com/dangom/dac2bids/blob/master/dac2bids.py
 
 @author: Marcel Zwiers
 """
+import os
 import copy
 import re
+import mmap
 import logging
 import tempfile
 import tarfile
 import zipfile
 from functools import lru_cache
-from pydicom import dcmread, fileset, datadict
+from pydicom import dcmread, fileset, datadict, Dataset
 from nibabel.parrec import parse_PAR_header
 from distutils.dir_util import copy_tree
 from typing import Union, List, Tuple
@@ -23,7 +25,8 @@ try:
 except ImportError:
     import bidscoin, dicomsort  # This should work if bidscoin was not pip-installed
 from ruamel.yaml import YAML
-yaml = YAML()
+yaml     = YAML()
+yamlsafe = YAML(typ='safe')                                    # The (faster, C-based) loader for read-only yaml-files, i.e. that are not saved back with their comments
 
 LOGGER = logging.getLogger(__name__)
 
@@ -36,9 +39,9 @@ unknowndatatype   = 'extra_data'
 bidsdatatypes = {}
 for _datatypefile in (bidscoin.schemafolder/'datatypes').glob('*.yaml'):
     with _datatypefile.open('r') as _stream:
-        bidsdatatypes[_datatypefile.stem] = yaml.load(_stream)
+        bidsdatatypes[_datatypefile.stem] = yamlsafe.load(_stream)
 with (bidscoin.schemafolder/'entities.yaml').open('r') as _stream:
-    entities = yaml.load(_stream)
+    entities = yamlsafe.load(_stream)
 
 
 class DataSource:
@@ -126,7 +129,8 @@ class DataSource:
                                          (match_attribute(file.stat().st_size, run['properties']['filesize']) or not run['properties']['filesize']))
                 return len([file for file in self.path.parent.glob('*') if match(file)])
             else:
-                return len(list(self.path.parent.glob('*')))
+                with os.scandir(self.path.parent) as entries:      # NB: Counts the directory entries without creating (and globbing) a Path for every file
+                    return sum(1 for _ in entries)
 
         return ''
 
@@ -287,20 +291,26 @@ def is_dicomfile(file: Path) -> bool:
     :return:        Returns true if a file is a DICOM-file
     """
 
-    if file.is_file():
-        if file.stem.startswith('.'):
-            LOGGER.warning(f'File is hidden: {file}')
-        with file.open('rb') as dicomfile:
-            dicomfile.seek(0x80, 1)
-            if dicomfile.read(4) == b'DICM':
-                return True
-        LOGGER.debug(f"Reading non-standard DICOM file: {file}")
-        if file.suffix.lower() in ('.ima','.dcm','.dicm','.dicom',''):           # Avoid memory problems when reading a very large (e.g. EEG) source file
-            dicomdata = dcmread(file, force=True)               # The DICM tag may be missing for anonymized DICOM files
-            return 'Modality' in dicomdata
-        # else:
-        #     dicomdata = dcmread(file)                         # NB: Raises an error for non-DICOM files
-        #     return 'Modality' in dicomdata
+    # Read the preamble + 'DICM' prefix in a single (unbuffered) read. Non-existing files and folders raise an OSError, i.e. no separate is_file() check is needed
+    try:
+        with file.open('rb', buffering=0) as dicomfile:
+            preamble = dicomfile.read(0x84)
+    except OSError:
+        if file.is_file():                                      # Do not hide real errors (e.g. a PermissionError) of existing files
+            raise
+        return False
+
+    if file.stem.startswith('.'):
+        LOGGER.warning(f'File is hidden: {file}')
+    if preamble[0x80:0x84] == b'DICM':
+        return True
+    LOGGER.debug(f"Reading non-standard DICOM file: {file}")
+    if file.suffix.lower() in ('.ima','.dcm','.dicm','.dicom',''):           # Avoid memory problems when reading a very large (e.g. EEG) source file
+        dicomdata = dcmread(file, force=True, stop_before_pixels=True)  # The DICM tag may be missing for anonymized DICOM files
+        return 'Modality' in dicomdata
+    # else:
+    #     dicomdata = dcmread(file)                             # NB: Raises an error for non-DICOM files
+    #     return 'Modality' in dicomdata
 
     return False
 
@@ -315,7 +325,16 @@ def is_dicomfile_siemens(file: Path) -> bool:
     :return:        Returns true if a file is a Siemens DICOM-file
     """
 
-    return b'ASCCONV BEGIN' in file.open('rb').read()
+    # Search the file in chunks (instead of reading it all in memory), with some overlap to catch matches at the chunk boundaries
+    marker = b'ASCCONV BEGIN'
+    with file.open('rb') as dicomfile:
+        overlap = b''
+        while chunk := dicomfile.read(2**20):
+            if marker in chunk or marker in overlap + chunk[:len(marker)-1]:
+                return True
+            overlap = chunk[-(len(marker)-1):]
+
+    return False
 
 
 def is_parfile(file: Path) -> bool:
@@ -327,7 +346,7 @@ def is_parfile(file: Path) -> bool:
     """
 
     # TODO: Implement a proper check, e.g. using nibabel
-    if file.is_file() and file.suffix in ('.PAR', '.par', '.XML', '.xml'):
+    if file.suffix in ('.PAR', '.par', '.XML', '.xml') and file.is_file():      # NB: Check the (cheap) suffix first to avoid stat-ing other files
         return True
     else:
         return False
@@ -335,7 +354,8 @@ def is_parfile(file: Path) -> bool:
 
 def get_dicomfile(folder: Path, index: int=0) -> Path:
     """
-    Gets a dicom-file from the folder (supports DICOMDIR)
+    Gets a dicom-file from the folder (supports DICOMDIR). NB: The files are searched in sorted order, so that e.g. the
+    AcquisitionTime of the returned (representative) file is that of the start of the acquisition
 
     :param folder:  The full pathname of the folder
     :param index:   The index number of the dicom file
@@ -346,11 +366,12 @@ def get_dicomfile(folder: Path, index: int=0) -> Path:
         dicomdir = fileset.FileSet(folder/'DICOMDIR')
         files    = [Path(file.path) for file in dicomdir]
     else:
-        files = sorted(folder.iterdir())
+        with os.scandir(folder) as entries:                    # NB: The directory entries (normally) know their filetype without stat-ing every file
+            files = sorted(folder/entry.name for entry in entries if entry.is_file())
 
     idx = 0
     for file in files:
-        if file.stem.startswith('.'):
+        if file.name.startswith('.'):
             LOGGER.warning(f'Ignoring hidden file: {file}')
             continue
         if is_dicomfile(file):
@@ -399,36 +420,84 @@ def get_datasource(session: Path, plugins: dict, recurse: bool=True) -> DataSour
     return datasource
 
 
+@lru_cache(maxsize=256)
+def _compile_x_protocol(regexp: str, pattern: str) -> Tuple[re.Pattern, bytes]:
+    """
+    Compiles the parse_x_protocol() regexp and gets a literal substring that any match must contain (if the pattern allows it),
+    so that parse_x_protocol() can jump directly to the first candidate line. The same tags are parsed from many DICOM files,
+    so this saves recompiling the same regexp over and over again
+
+    :param regexp:  The regexp that is searched for in the dicom-file
+    :param pattern: The pattern from which regexp was derived
+    :return:        Tuple with (1) the compiled regexp and (2) the literal substring (or b'')
+    """
+
+    regex   = re.compile(regexp.encode('utf-8'), re.MULTILINE)
+    literal = b'' if re.search(r'[\\|?*{}()\[\]]', pattern) else max(re.split(r'[.^$+]', pattern), key=len).encode('utf-8')
+
+    return regex, literal
+
+
 def parse_x_protocol(pattern: str, dicomfile: Path) -> str:
     """
     Siemens writes a protocol structure as text into each DICOM file.
     This structure is necessary to recreate a scanning protocol from a DICOM,
-    since the DICOM information alone wouldn't be sufficient.
+    since the DICOM information alone wouldn't be sufficient. The (first) 'ASCCONV BEGIN' ... 'ASCCONV END'
+    protocol section is searched first, the rest of the file is only searched if no match was found in there
 
     :param pattern:     A regexp expression: '^' + pattern + '\t = \t(.*)\\n'
     :param dicomfile:   The full pathname of the dicom-file
     :return:            The string extracted values from the dicom-file according to the given pattern
     """
 
-    if not is_dicomfile_siemens(dicomfile):
-        LOGGER.warning(f"Parsing {pattern} may fail because {dicomfile} does not seem to be a Siemens DICOM file")
+    regexp         = '^' + pattern + '\t = \t(.*)\n'
+    regex, literal = _compile_x_protocol(regexp, pattern)
 
-    regexp = '^' + pattern + '\t = \t(.*)\n'
-    regex  = re.compile(regexp.encode('utf-8'))
+    # Empty files cannot be memory-mapped (and contain nothing to parse)
+    if not dicomfile.stat().st_size:
+        LOGGER.warning(f"Pattern: '{regexp.encode('unicode_escape').decode()}' not found in: {dicomfile}")
+        return ''
 
-    with dicomfile.open('rb') as openfile:
-        for line in openfile:
-            match = regex.match(line)
-            if match:
-                return match.group(1).decode('utf-8')
+    # Search the memory-mapped file in one go, i.e. without splitting the (binary) file into lines
+    with dicomfile.open('rb') as openfile, mmap.mmap(openfile.fileno(), 0, access=mmap.ACCESS_READ) as mapfile:
+
+        # Search the (first) protocol section first and then the whole file. Finding the section also checks if it is a Siemens DICOM file (see is_dicomfile_siemens()) without reading the file twice
+        start = mapfile.find(b'ASCCONV BEGIN')
+        end   = mapfile.find(b'ASCCONV END', start)
+        if start < 0:
+            LOGGER.warning(f"Parsing {pattern} may fail because {dicomfile} does not seem to be a Siemens DICOM file")
+            sections = [(0, len(mapfile))]
+        else:
+            sections = [(start, end if end >= 0 else len(mapfile)), (0, len(mapfile))]
+
+        for start, end in sections:
+            offset = mapfile.find(literal, start, end)
+            if offset >= 0:
+                match = regex.search(mapfile, mapfile.rfind(b'\n', 0, offset) + 1, end)    # Start at the beginning of the candidate line
+                if match:
+                    return match.group(1).decode('utf-8')
 
     LOGGER.warning(f"Pattern: '{regexp.encode('unicode_escape').decode()}' not found in: {dicomfile}")
     return ''
 
 
-# Profiling shows this is currently the most expensive function, so therefore the (primitive but effective) _DICOMDICT_CACHE optimization
-_DICOMDICT_CACHE = None
-_DICOMFILE_CACHE = None
+# Profiling shows get_dicomfield() is currently the most expensive function, so therefore the (primitive but effective) _read_dicomdata() cache optimization
+@lru_cache(maxsize=8)
+def _read_dicomdata(dicomfile: Path) -> Dataset:
+    """
+    Reads the DICOM header of a file. The most recently read datasets are cached, as many fields are typically read from the same few files
+
+    :param dicomfile:   The full pathname of the dicom-file
+    :return:            The DICOM dataset (without the pixel data)
+    """
+
+    dicomdata = dcmread(dicomfile, force=True, stop_before_pixels=True)     # The DICM tag may be missing for anonymized DICOM files
+    if 'Modality' not in dicomdata:
+        raise ValueError(f'Cannot read {dicomfile}')
+
+    return dicomdata
+
+
 @lru_cache(maxsize=4096)
 def get_dicomfield(tagname: str, dicomfile: Path) -> Union[str, int]:
     """
@@ -439,41 +508,23 @@ def get_dicomfield(tagname: str, dicomfile: Path) -> Union[str, int]:
     :return:            Extracted tag-values from the dicom-file
     """
 
-    global _DICOMDICT_CACHE, _DICOMFILE_CACHE
-
-    if not dicomfile.is_file():
-        LOGGER.debug(f"{dicomfile} not found")
-        value = ''
-
-    elif not is_dicomfile(dicomfile):
-        LOGGER.warning(f"{dicomfile} is not a DICOM file, cannot read {tagname}")
+    if not is_dicomfile(dicomfile):                             # NB: Also False for non-existing files, so we only need to stat the file if it is not a DICOM file
+        if not dicomfile.is_file():
+            LOGGER.debug(f"{dicomfile} not found")
+        else:
+            LOGGER.warning(f"{dicomfile} is not a DICOM file, cannot read {tagname}")
         value = ''
 
     else:
         try:
-            if dicomfile != _DICOMFILE_CACHE:
-                dicomdata = dcmread(dicomfile, force=True)          # The DICM tag may be missing for anonymized DICOM files
-                if 'Modality' not in dicomdata:
-                    raise ValueError(f'Cannot read {dicomfile}')
-                _DICOMDICT_CACHE = dicomdata
-                _DICOMFILE_CACHE = dicomfile
-            else:
-                dicomdata = _DICOMDICT_CACHE
-
-            value = dicomdata.get(tagname, '')
-
-            # Try a recursive search
-            if not value:
-                for elem in dicomdata.iterall():
-                    if tagname in (elem.name, elem.keyword):
-                        value = elem.value
-                        break
+            dicomdata = _read_dicomdata(dicomfile)
 
         except OSError:
             LOGGER.warning(f'Cannot read {tagname} from {dicomfile}')
             value = ''
 
-        except Exception as dicomerror:
+        except Exception:
+            # Only fall back to (the costly) text parsing of the file if pydicom could not read it, i.e. not if the tag is missing
             try:
                 value = parse_x_protocol(tagname, dicomfile)
 
@@ -481,8 +532,25 @@ def get_dicomfield(tagname: str, dicomfile: Path) -> Union[str, int]:
                 LOGGER.warning(f'Could not parse {tagname} from {dicomfile}\n{dicomerror}')
                 value = ''
 
+        else:
+            try:
+                value = dicomdata.get(tagname, '')
+
+                # Try a recursive search
+                if not value:
+                    for elem in dicomdata.iterall():
+                        if tagname in (elem.name, elem.keyword):
+                            value = elem.value
+                            break
+
+            except Exception as dicomerror:
+                LOGGER.warning(f'Could not read {tagname} from {dicomfile}\n{dicomerror}')
+                value = ''
+
     # Cast the dicom datatype to int or str (i.e. to something that yaml.dump can handle)
-    if isinstance(value, int):
+    if type(value) in (int, str):       # Nothing to cast (NB: not the case for subclasses, such as pydicom's IS and UID)
+        return value
+    elif isinstance(value, int):
         return int(value)
     elif value is None:
         return ''
@@ -534,7 +602,9 @@ def get_parfield(tagname: str, parfile: Path) -> Union[str, int]:
             value = ''
 
     # Cast the dicom datatype to int or str (i.e. to something that yaml.dump can handle)
-    if isinstance(value, int):
+    if type(value) in (int, str):       # Nothing to cast (NB: not the case for the numpy values that nibabel returns)
+        return value
+    elif isinstance(value, int):
         return int(value)
     elif value is None:
         return ''
@@ -742,6 +812,8 @@ def strip_suffix(run: dict) -> dict:
     return run
 
 
+_cleanup_table = str.maketrans('', '', ' _-.')     # Special characters that are removed by cleanup_value()
+_cleanup_regex = re.compile(r'(?u)[^-\w.]')
 def cleanup_value(label: str) -> str:
     """
     Converts a given label to a cleaned-up label that can be used as a BIDS label. Remove leading and trailing spaces;
@@ -757,12 +829,7 @@ def cleanup_value(label: str) -> str:
     if not isinstance(label, str):
         return label
 
-    special_characters = (' ', '_', '-','.')
-
-    for special in special_characters:
-        label = label.strip().replace(special, '')
-
-    return re.sub(r'(?u)[^-\w.]', '', label)
+    return _cleanup_regex.sub('', label.strip().translate(_cleanup_table))
 
 
 def dir_bidsmap(bidsmap: dict, dataformat: str) -> List[Path]:
@@ -1052,36 +1119,24 @@ def exist_run(bidsmap: dict, datatype: str, run_item: dict, matchbidslabels: boo
 
     for run in bidsmap[run_item['datasource'].dataformat][datatype]:
 
-        # Begin with match = False only if all attributes are empty
-        match = any([run[matching][attrkey] not in [None,''] for matching in ('properties','attributes') for attrkey in run[matching]])  # Normally match==True, but make match==False if all attributes are empty
+        # Runs with only empty properties / attributes never match
+        if not any(run[matching][attrkey] not in (None,'') for matching in ('properties','attributes') for attrkey in run[matching]):
+            continue
 
-        # Search for a case where all run_item items match with the run_item items
-        for matching in ('properties', 'attributes'):
-            for itemkey, itemvalue in run_item[matching].items():
-                value = run[matching].get(itemkey)          # Matching bids-labels which exist in one datatype but not in the other -> None
-                match = match and match_attribute(itemvalue, value)
-                if not match:
-                    break                                   # There is no point in searching further within the run_item now that we've found a mismatch
+        # Search for a case where all run_item items match with the run items. NB: Keys which exist in one run but not in the other -> None
+        if not all(match_attribute(itemvalue, run[matching].get(itemkey)) for matching in ('properties','attributes') for itemkey, itemvalue in run_item[matching].items()):
+            continue
 
         # See if the bidskeys also all match. This is probably not very useful, but maybe one day...
-        if matchbidslabels and match:
-            for itemkey, itemvalue in run_item['bids'].items():
-                value = run['bids'].get(itemkey)            # Matching bids-labels which exist in one datatype but not in the other -> None
-                match = match and value==itemvalue
-                if not match:
-                    break                                   # There is no point in searching further within the run_item now that we've found a mismatch
+        if matchbidslabels and not all(run['bids'].get(itemkey)==itemvalue for itemkey, itemvalue in run_item['bids'].items()):
+            continue
 
-        # See if the bidskeys also all match. This is probably not very useful, but maybe one day...
-        if matchmetalabels and match:
-            for itemkey, itemvalue in run_item['meta'].items():
-                value = run['meta'].get(itemkey)            # Matching bids-labels which exist in one datatype but not in the other -> None
-                match = match and value==itemvalue
-                if not match:
-                    break                                   # There is no point in searching further within the run_item now that we've found a mismatch
+        # See if the metakeys also all match. This is probably not very useful, but maybe one day...
+        if matchmetalabels and not all(run['meta'].get(itemkey)==itemvalue for itemkey, itemvalue in run_item['meta'].items()):
+            continue
 
-        # Stop searching if we found a matching run_item (i.e. which is the case if match is still True after all run tests)
-        if match:
-            return True
+        # Stop searching if we found a matching run_item (i.e. which is the case if all run tests passed)
+        return True
 
     return False
 
@@ -1472,7 +1527,7 @@ def get_metahelp(metakey: str) -> str:
     metafile = bidscoin.schemafolder/'metadata'/(metakey + '.yaml')
     if metafile.is_file():
         with metafile.open('r') as stream:
-            metadata = yaml.load(stream)
+            metadata = yamlsafe.load(stream)
         if metakey == 'IntendedFor':    # IntendedFor is a special search-pattern field in BIDScoin
             metadata['description'] += ('\nThese associated files can be dynamically searched for during'
                                         '\nbidscoiner runtime with glob-style matching patterns such as'
@@ -11,6 +11,7 @@ For more documentation see: https://bidscoin.readthedocs.io
 """
 
 import argparse
+import os
 import textwrap
 import tarfile
 import shutil
@@ -23,6 +24,7 @@ import subprocess
 import urllib.request
 import json
 from pathlib import Path
+from fnmatch import fnmatch
 from functools import lru_cache
 from importlib.util import spec_from_file_location, module_from_spec
 from importlib.metadata import entry_points
@@ -60,6 +62,11 @@ def setup_logging(log_file: Path=Path(), debug: bool=False):
     datefmt   = '%Y-%m-%d %H:%M:%S'
     formatter = logging.Formatter(fmt=fmt, datefmt=datefmt)
 
+    # Do not walk the call stack to find the source file, line number and function name of every log record, as they are not logged anyway.
+    # NB: Like the root logger setup above and below, this is intentionally process-wide, i.e. other loggers will then report '(unknown file)',
+    # line 0 and '(unknown function)'. This is fine for the BIDScoin tools, which own the process and are the ones calling setup_logging()
+    logging._srcfile = None
+
     # Set & add the streamhandler and add some color to those boring terminal logs! :-)
     coloredlogs.install(level=logger.level, fmt=fmt, datefmt=datefmt)
 
@@ -175,7 +182,15 @@ def lsdirs(folder: Path, wildcard: str='*') -> List[Path]:
     :return:            A list with all directories in the folder
     """
 
-    return [fname for fname in sorted(folder.glob(wildcard)) if fname.is_dir() and not fname.name.startswith('.')]
+    # Recursive ('**') and subfolder glob patterns cannot be matched against the directory entries
+    if not wildcard or '**' in wildcard or '/' in wildcard or os.sep in wildcard:
+        return [fname for fname in sorted(folder.glob(wildcard)) if fname.is_dir() and not fname.name.startswith('.')]
+
+    # Scan the directory entries, which (normally) know their filetype without stat-ing every entry
+    if not folder.is_dir():
+        return []
+    with os.scandir(folder) as entries:
+        return sorted(folder/entry.name for entry in entries if fnmatch(entry.name, wildcard) and not entry.name.startswith('.') and entry.is_dir())
 
 
 def list_executables(show: bool=False) -> list:
@@ -1,7 +1,10 @@
 import unittest
 import os
+import tempfile
+from pathlib import Path
 
-from bidscoin.bids import bidsversion, version
+from bidscoin.bidscoin import bidsversion, version
+from bidscoin.bids import is_dicomfile_siemens, parse_x_protocol
 
 
 class TestBids(unittest.TestCase):
@@ -19,5 +22,87 @@ class TestBids(unittest.TestCase):
         self.assertEqual(bids_v, bids_v_from_file)
 
 
+class TestSiemens(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir   = tempfile.TemporaryDirectory()
+        self.dicomfile = Path(self.tempdir.name)/'siemens.dcm'
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_is_dicomfile_siemens(self):
+        marker = b'ASCCONV BEGIN'
+        for offset in range(2**20 - len(marker), 2**20 + 1):    # Around the 1 MiB chunk boundary
+            data = bytearray(2**21)
+            data[offset:offset+len(marker)] = marker
+            self.dicomfile.write_bytes(data)
+            self.assertTrue(is_dicomfile_siemens(self.dicomfile), f"Marker at offset {offset}")
+        self.dicomfile.write_bytes(bytes(2**21 - len(marker)) + marker)
+        self.assertTrue(is_dicomfile_siemens(self.dicomfile))
+        self.dicomfile.write_bytes(bytes(2**20 - 6) + b'ASCCONV' + bytes(2**20) + b' BEGIN')
+        self.assertFalse(is_dicomfile_siemens(self.dicomfile))
+        self.dicomfile.write_bytes(b'')
+        self.assertFalse(is_dicomfile_siemens(self.dicomfile))
+
+    def test_parse_x_protocol_patterns(self):
+        self.dicomfile.write_bytes(b'\x00\x01DICM binary ucDimension \xff\n'
+                                   b'### ASCCONV BEGIN ###\n'
+                                   b'xsKSpace.ucDimension\t = \t0x1\n'
+                                   b'sKSpace.ucDimension\t = \t0x4\n'
+                                   b'sKSpaceXucMode\t = \t0x2\n'
+                                   b'alTR[0]\t = \t2000000\n'
+                                   b'sRXSPEC.alDwellTime[0]\t = \t7800\n'
+                                   b'asCoilSelectMeas0\t = \t3\n'
+                                   b'lAverages\t = \t1\n'
+                                   b'lRepetitions\t = \t5\n'
+                                   b'### ASCCONV END ###\n')
+        self.assertEqual(parse_x_protocol('sKSpace.ucDimension', self.dicomfile), '0x4')      # The first literal hits are non-matching lines
+        self.assertEqual(parse_x_protocol('sKSpace.ucMode', self.dicomfile), '0x2')           # '.' is a regexp wildcard
+        self.assertEqual(parse_x_protocol('lRep+etitions', self.dicomfile), '5')
+        self.assertEqual(parse_x_protocol('^lRepetitions', self.dicomfile), '5')
+        self.assertEqual(parse_x_protocol(r'alTR\[0\]', self.dicomfile), '2000000')
+        self.assertEqual(parse_x_protocol(r'sRXSPEC\.alDwellTime\[0\]', self.dicomfile), '7800')
+        self.assertEqual(parse_x_protocol('asCoilSelectMeas[0]', self.dicomfile), '3')        # '[0]' is a regexp character class
+        self.assertEqual(parse_x_protocol('l(Averages|Repetitions)', self.dicomfile), 'Averages')
+        self.assertEqual(parse_x_protocol('ucDimension', self.dicomfile), '')
+        self.assertEqual(parse_x_protocol('lMissing', self.dicomfile), '')
+
+    def test_parse_x_protocol_file(self):
+        self.dicomfile.write_bytes(b'\x00\x01DICM\xff\xfe binary data\r\x00\n'
+                                   b'lRepetitions\t = \t5\n'
+                                   b'\x00\xff binary data\n'
+                                   b'lAverages\t = \t1')                                       # NB: The last line has no newline
+        self.assertEqual(parse_x_protocol('lRepetitions', self.dicomfile), '5')
+        self.assertEqual(parse_x_protocol('lAverages', self.dicomfile), '')
+        self.dicomfile.write_bytes(b'')
+        self.assertEqual(parse_x_protocol('lRepetitions', self.dicomfile), '')
+
+    def test_parse_x_protocol_cache(self):
+        otherfile = Path(self.tempdir.name)/'other.dcm'
+        self.dicomfile.write_bytes(b'\x00\x01\nlRepetitions\t = \t5\n')
+        otherfile.write_bytes(b'\x00\x01\nlRepetitions\t = \t7\n')
+        self.assertEqual(parse_x_protocol('lRepetitions', self.dicomfile), '5')
+        self.assertEqual(parse_x_protocol('lRepetitions', otherfile), '7')
+        self.assertEqual(parse_x_protocol('lRepetitions', self.dicomfile), '5')
+
+    def test_parse_x_protocol_sections(self):
+        self.dicomfile.write_bytes(b'\x00\x01\n'
+                                   b'lAverages\t = \t0\n'
+                                   b'### ASCCONV BEGIN ###\n'
+                                   b'lAverages\t = \t1\n'
+                                   b'lRepetitions\t = \t5\n'
+                                   b'### ASCCONV END ###\n'
+                                   b'lAfterSection\t = \t6\n'
+                                   b'### ASCCONV BEGIN ###\n'
+                                   b'lSecondSection\t = \t7\n'
+                                   b'### ASCCONV END ###\n')
+        self.assertEqual(parse_x_protocol('lAverages', self.dicomfile), '1')                 # The first protocol section is searched first
+        self.assertEqual(parse_x_protocol('lRepetitions', self.dicomfile), '5')
+        self.assertEqual(parse_x_protocol('lAfterSection', self.dicomfile), '6')
+        self.assertEqual(parse_x_protocol('lSecondSection', self.dicomfile), '7')
+        self.assertEqual(parse_x_protocol('lMissing', self.dicomfile), '')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+import tempfile
+from pathlib import Path
+
+from bidscoin.bidscoin import lsdirs
+
+
+class TestBidscoin(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.folder  = Path(self.tempdir.name)
+        for name in ('sub-02', 'sub-01', '.sub-03', 'ses-01', 'sub-04.dir'):
+            (self.folder/name).mkdir()
+        (self.folder/'sub-05').write_text('')
+        (self.folder/'sub-06').symlink_to(self.folder/'sub-01', target_is_directory=True)
+        (self.folder/'sub-07').symlink_to(self.folder/'sub-05')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_lsdirs(self):
+        self.assertEqual(lsdirs(self.folder), [self.folder/name for name in ('ses-01', 'sub-01', 'sub-02', 'sub-04.dir', 'sub-06')])
+        self.assertEqual(lsdirs(self.folder, 'sub-*'), [self.folder/name for name in ('sub-01', 'sub-02', 'sub-04.dir', 'sub-06')])
+        self.assertEqual(lsdirs(self.folder, 'sub-0?'), [self.folder/name for name in ('sub-01', 'sub-02', 'sub-06')])
+        self.assertEqual(lsdirs(self.folder, '*/'), lsdirs(self.folder))
+        (self.folder/'sub-01'/'ses-01').mkdir()
+        self.assertEqual(lsdirs(self.folder, '**'), [self.folder] + [self.folder/name for name in ('ses-01', 'sub-01', 'sub-01/ses-01', 'sub-02', 'sub-04.dir')])     # NB: glob('**') does not follow symlinks
+        self.assertEqual(lsdirs(self.folder, 'sub-*/ses-*'), [self.folder/'sub-01'/'ses-01', self.folder/'sub-06'/'ses-01'])
+        self.assertEqual(lsdirs(self.folder, 'sub-05'), [])
+        self.assertEqual(lsdirs(self.folder/'sub-05'), [])
+        self.assertEqual(lsdirs(self.folder/'missing'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()